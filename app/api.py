@@ -1,9 +1,18 @@
 import os
+import time
+import queue
+import hashlib
+import sqlite3
 import logging
-from fastapi import FastAPI, HTTPException, Depends
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from enum import Enum
+from anyio import to_thread
+from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.engine import Connection
+from sqlalchemy.pool import QueuePool
 from pydantic import BaseModel
 from typing import List, Dict, Any
 
@@ -12,9 +21,87 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 DB_PATH = '/app/database/data.db'
 # Usamos check_same_thread=False solo porque es Sqlite
-DB_ENGINE = create_engine(f'sqlite:///{DB_PATH}', connect_args={"check_same_thread": False})
+DB_ENGINE = create_engine(
+  f'sqlite:///{DB_PATH}',
+  connect_args={"check_same_thread": False, "timeout": 30},
+  poolclass=QueuePool,
+  pool_size=5,
+  max_overflow=10,
+  pool_pre_ping=True
+)
+
+# Lecturas vía memoria mapeada (256 MiB)
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# PRAGMAs aplicados a cada conexión nueva del pool
+SQLITE_PRAGMAS = (
+  "PRAGMA journal_mode=WAL",
+  "PRAGMA synchronous=NORMAL",
+  "PRAGMA temp_store=MEMORY",
+  "PRAGMA cache_size=-64000",
+  f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+)
+
+def apply_sqlite_pragmas(dbapi_connection):
+  cursor = dbapi_connection.cursor()
+  try:
+    for pragma in SQLITE_PRAGMAS:
+      cursor.execute(pragma)
+    # Sqlite ignora mmap_size en silencio si se compiló sin soporte de mmap
+    mmap_size = cursor.execute("PRAGMA mmap_size").fetchone()[0]
+    if mmap_size != SQLITE_MMAP_SIZE:
+      logging.warning(f"SQLite mmap_size is {mmap_size}, expected {SQLITE_MMAP_SIZE}.")
+  finally:
+    cursor.close()
+
+@event.listens_for(DB_ENGINE, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+  apply_sqlite_pragmas(dbapi_connection)
+
+# Pool de conexiones sqlite3 directas para las lecturas frecuentes (/etl_runs, /data).
+# SQLAlchemy se queda solo para /query_sql.
+RAW_POOL_SIZE = 4
+_raw_pool = queue.Queue(maxsize=RAW_POOL_SIZE)
+_raw_pool_lock = threading.Lock()
+_raw_pool_created = 0
 
-app = FastAPI(title="Technical Test API", version="1.0")
+def _new_raw_connection():
+  conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, timeout=30)
+  conn.row_factory = sqlite3.Row
+  apply_sqlite_pragmas(conn)
+  return conn
+
+def _acquire_raw_connection():
+  global _raw_pool_created
+  try:
+    return _raw_pool.get_nowait()
+  except queue.Empty:
+    pass
+
+  # Las conexiones se crean bajo demanda (la DB puede no existir al arrancar)
+  with _raw_pool_lock:
+    if _raw_pool_created < RAW_POOL_SIZE:
+      _raw_pool_created += 1
+      try:
+        return _new_raw_connection()
+      except Exception:
+        _raw_pool_created -= 1
+        raise
+
+  return _raw_pool.get(timeout=30)
+
+# Los endpoints síncronos corren en el threadpool de anyio (40 hilos por defecto);
+# si Sqlite está bloqueado por una escritura del saver, se agota y las peticiones se encolan
+API_THREADPOOL_SIZE = 100
+
+@asynccontextmanager
+async def lifespan(app):
+  # El limitador es del bucle de eventos: se configura al arrancar, ya dentro del bucle
+  to_thread.current_default_thread_limiter().total_tokens = API_THREADPOOL_SIZE
+  yield
+
+# Con response_model, FastAPI serializa directamente con Pydantic (sin pasar por json de la stdlib)
+app = FastAPI(title="Technical Test API", version="1.0", lifespan=lifespan)
 
 # --- Configuración de CORS ---
 # Permite que el frontend pueda llamar a la api
@@ -31,13 +118,27 @@ def get_db_connection():
   if not os.path.exists(DB_PATH):
     raise HTTPException(status_code=503, detail="The database hasn't been created yet. Run the pipeline first.")
   
-  conn = None
+  # El pool recupera la conexión al salir del bloque
+  with DB_ENGINE.connect() as conn:
+    yield conn
+
+@contextmanager
+def raw_db_connection():
+  if not os.path.exists(DB_PATH):
+    raise HTTPException(status_code=503, detail="The database hasn't been created yet. Run the pipeline first.")
+
+  try:
+    conn = _acquire_raw_connection()
+  except queue.Empty:
+    raise HTTPException(status_code=503, detail="No database connections available. Try again later.")
   try:
-    conn = DB_ENGINE.connect()
     yield conn
   finally:
-    if conn:
-      conn.close()
+    _raw_pool.put(conn)
+
+def get_raw_db_connection():
+  with raw_db_connection() as conn:
+    yield conn
 
 # --- Modelos de Datos ---
 class EtlRun(BaseModel):
@@ -47,6 +148,15 @@ class EtlRun(BaseModel):
   valid_count: int
   invalid_count: int
 
+class TableName(str, Enum):
+  raw_users = "raw_users"
+  processed_users = "processed_users"
+  invalid_users = "invalid_users"
+
+# --- Cache de /etl_runs ---
+ETL_RUNS_CACHE_TTL = 5
+_etl_runs_cache = {'t': 0.0, 'runs': None, 'etag': None}
+
 # --- Endpoints ---
 
 @app.get("/")
@@ -54,45 +164,44 @@ def read_root():
   return {"status": "Pipeline API working"}
 
 @app.get("/etl_runs", response_model=List[EtlRun])
-def get_etl_runs(db: Connection = Depends(get_db_connection)):
-  try:
-    query = text("SELECT id, run_timestamp, processed_file, valid_count, invalid_count FROM etl_runs ORDER BY run_timestamp DESC")
-    result = db.execute(query).fetchall()
-    
-    # Mapea los resultados a un formato de lista de diccionarios
-    runs = [
-      {
-        "id": row[0],
-        "run_timestamp": row[1],
-        "processed_file": row[2],
-        "valid_count": row[3],
-        "invalid_count": row[4]
-      } for row in result
-    ]
-    return runs
-  except Exception as e:
-    logging.error(f"Error get runs: {e}")
-    # Si la tabla 'etl_runs' aún no existe
-    raise HTTPException(status_code=500, detail=f"Error consulting the database: {e}")
+def get_etl_runs(request: Request, response: Response):
+  # Las runs nuevas llegan como mucho una vez por ciclo: se cachean unos segundos.
+  # Solo se toma una conexión del pool cuando la cache caduca
+  if _etl_runs_cache['runs'] is None or time.monotonic() - _etl_runs_cache['t'] >= ETL_RUNS_CACHE_TTL:
+    with raw_db_connection() as db:
+      try:
+        query = "SELECT id, run_timestamp, processed_file, valid_count, invalid_count FROM etl_runs ORDER BY run_timestamp DESC"
+        result = db.execute(query).fetchall()
+
+        # Mapea los resultados (sqlite3.Row) a un formato de lista de diccionarios
+        runs = [dict(row) for row in result]
+      except Exception as e:
+        logging.error(f"Error get runs: {e}")
+        # Si la tabla 'etl_runs' aún no existe
+        raise HTTPException(status_code=500, detail=f"Error consulting the database: {e}")
+
+    # Las runs solo se insertan, así que el id máximo identifica la versión
+    max_id = max((run['id'] for run in runs), default=0)
+    etag = f'"{hashlib.md5(str(max_id).encode()).hexdigest()}"'
+    _etl_runs_cache.update({'t': time.monotonic(), 'runs': runs, 'etag': etag})
+
+  etag = _etl_runs_cache['etag']
+  if request.headers.get('If-None-Match') == etag:
+    return Response(status_code=304, headers={'ETag': etag})
+
+  response.headers['ETag'] = etag
+  return _etl_runs_cache['runs']
 
 @app.get("/data/{table_name}", response_model=List[Dict[str, Any]])
-def get_data_by_table(table_name: str, db: Connection = Depends(get_db_connection)):
-  allowed_tables = ["raw_users", "processed_users", "invalid_users"]
-  if table_name not in allowed_tables:
-    raise HTTPException(status_code=400, detail="TableName not Allowed. Valid names: raw_users, processed_users, invalid_users.")
-      
+def get_data_by_table(table_name: TableName, db: sqlite3.Connection = Depends(get_raw_db_connection)):
+  # FastAPI ya rechaza (422) los nombres que no están en TableName
   try:
-    query = text(f"SELECT * FROM {table_name} LIMIT 100") 
-    result = db.execute(query)
-    
-    # Convertir el resultado de SQLAlchemy a un diccionario
-    column_names = result.keys()
-    data = [dict(zip(column_names, row)) for row in result.fetchall()]
-    return data
+    query = f"SELECT * FROM {table_name.value} LIMIT 100"
+    return [dict(row) for row in db.execute(query).fetchall()]
       
   except Exception as e:
-    logging.error(f"Error al obtener datos de {table_name}: {e}")
-    raise HTTPException(status_code=500, detail=f"Error al consultar la tabla {table_name}: {e}")
+    logging.error(f"Error al obtener datos de {table_name.value}: {e}")
+    raise HTTPException(status_code=500, detail=f"Error al consultar la tabla {table_name.value}: {e}")
 
 # --- Endpoint para el la SQL Box ---
 class SqlQuery(BaseModel):
@@ -111,9 +220,8 @@ def execute_sql_query(query_data: SqlQuery, db: Connection = Depends(get_db_conn
     
     # Para consultas SELECT, devuelve los datos
     if query.startswith("SELECT"):
-      column_names = result.keys()
-      data = [dict(zip(column_names, row)) for row in result.fetchall()]
-      return {"columns": list(column_names), "rows": data}
+      rows = result.mappings().all()
+      return {"columns": list(result.keys()), "rows": rows}
     else:
       # Para INSERT, UPDATE, DELETE... en caso de permitirse
       return {"message": "Query executed.", "row_count": result.rowcount}
@@ -1,8 +1,12 @@
 import os
+import gzip
 import redis
 import json
+import signal
 import time
-import requests
+import httpx
+import orjson
+import asyncio
 import logging
 from datetime import datetime
 from dotenv import load_dotenv
@@ -22,7 +26,10 @@ BATCH_SIZE = int(os.getenv('BATCH_SIZE', 100))
 SLEEP_INTERVAL = int(os.getenv('SLEEP_INTERVAL_SECONDS', 60))
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+PHASE1_STREAM = 'stream:phase1_complete'
 MAX_RETRIES = 3
+STATE_FLUSH_EVERY = 10
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', 8))
 STATE_FILE_PATH = 'data/state/extractor_state.json'
 OUTPUT_DIR = 'data/raw_users'
 
@@ -49,100 +56,164 @@ def save_state(skip_value):
 
 # --- Lógica Principal del Extractor ---
 
-def fetch_batch(session, skip, limit):
-  url = f"{API_BASE_URL}?limit={limit}&skip={skip}"
+async def fetch_batch(client, skip, limit):
+  # httpx codifica los parámetros y ya pide gzip por defecto (Accept-Encoding)
+  params = {'limit': limit, 'skip': skip}
 
   for attempt in range(MAX_RETRIES):
     try:
-      response = session.get(url, timeout=10)
+      response = await client.get(API_BASE_URL, params=params, timeout=10)
 
       if response.status_code == 200:
         return response.json()
       else:
         logging.warning(f"API return status {response.status_code}. Retry {attempt + 1}/{MAX_RETRIES}...")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
       logging.warning(f"Exception in request: {e}. Retry {attempt + 1}/{MAX_RETRIES}...")
 
     if attempt < MAX_RETRIES - 1:
       wait_time = 5 * (3 ** attempt)
-      time.sleep(wait_time)
+      await asyncio.sleep(wait_time)
 
   logging.error(f"Failed all {MAX_RETRIES} tries for the 'skip' {skip}.")
   return None
 
-def run_extraction():
+async def fetch_batch_limited(client, semaphore, skip, limit):
+  async with semaphore:
+    logging.info(f"Requesting batch: 'limit'={limit}, 'skip'={skip}")
+    return await fetch_batch(client, skip, limit)
+
+async def run_extraction():
   logging.info("Starting new extraction cycle")
 
   current_skip = load_state()
 
   os.makedirs(OUTPUT_DIR, exist_ok=True)
   timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-  output_filename = os.path.join(OUTPUT_DIR, f'records_{timestamp}.jsonl')
+  output_filename = os.path.join(OUTPUT_DIR, f'records_{timestamp}.jsonl.gz')
 
-  total_users = -1
   processed_count_in_run = 0
-
-  with requests.Session() as session:
-    while True:
+  batches_in_run = 0
+  saved_skip = current_skip
+  completed = False
+  pending = []
+
+  # El archivo se abre con el primer batch (una sola vez por ciclo, comprimido con gzip):
+  # un ciclo que falla antes de escribir no deja un .jsonl.gz vacío
+  f = None
+  async with httpx.AsyncClient(http2=True) as client:
+    try:
+      # La primera página da el total; las demás se piden en paralelo
       logging.info(f"Requesting batch: 'limit'={BATCH_SIZE}, 'skip'={current_skip}")
-
-      data = fetch_batch(session, skip=current_skip, limit=BATCH_SIZE)
+      data = await fetch_batch(client, skip=current_skip, limit=BATCH_SIZE)
 
       if data is None:
         logging.error("Extraction failed. The state 'skip' wont change. Exit the process.")
         return False
-    
-      users = data.get('users', [])
-      if total_users == -1:
-        total_users = data.get('total', 0)
-        logging.info(f"Total de usuarios a extraer: {total_users}")
 
-      if not users:
+      users = data.get('users', [])
+      total_users = data.get('total', 0)
+      logging.info(f"Total de usuarios a extraer: {total_users}")
+
+      if users:
+        page_size = len(users)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        pending = [
+          asyncio.create_task(fetch_batch_limited(client, semaphore, skip, page_size))
+          for skip in range(current_skip + page_size, total_users, page_size)
+        ]
+      next_batches = iter(pending)
+
+      # Las respuestas se escriben en orden de 'skip' para que el estado siga siendo contiguo
+      while users:
+        try:
+          if f is None:
+            f = gzip.open(output_filename, 'ab')
+          # Una sola escritura por batch
+          f.write(b''.join(orjson.dumps(user, option=orjson.OPT_APPEND_NEWLINE) for user in users))
+        except IOError as e:
+          logging.error(f"Error writing in {output_filename}. Aborting. Error: {e}")
+          return False
+
+        current_skip += len(users)
+        processed_count_in_run += len(users)
+        batches_in_run += 1
+
+        # El estado se persiste cada STATE_FLUSH_EVERY batches (y al salir, ver finally).
+        # Nunca debe adelantarse a los datos escritos.
+        if batches_in_run % STATE_FLUSH_EVERY == 0:
+          f.flush()
+          save_state(current_skip)
+          saved_skip = current_skip
+
+        logging.info(f"Batch saved. Progress: {current_skip}/{total_users}")
+
+        if current_skip >= total_users:
+          logging.info(f"Extraction completed. Total users extracted this run: {processed_count_in_run}.")
+          break
+
+        task = next(next_batches, None)
+        if task is None:
+          break
+
+        data = await task
+        if data is None:
+          logging.error(f"Extraction failed. The state 'skip' stays at {current_skip}. Exit the process.")
+          return False
+        users = data.get('users', [])
+      else:
         logging.info("No more users. Pagination completed")
-        break
-
-      try:
-        with open(output_filename, 'a', encoding='utf-8') as f:
-          for user in users:
-            f.write(json.dumps(user) + '\n')
-      except IOError as e:
-        logging.error(f"Error writing in {output_filename}. Aborting. Error: {e}")
-        return False
-      
-      current_skip += len(users)
-      processed_count_in_run += len(users)
-
-      save_state(current_skip)
 
-      logging.info(f"Batch saved. Progress: {current_skip}/{total_users}")
-
-      if current_skip >= total_users:
-        logging.info(f"Extraction completed. Total users extracted this run: {processed_count_in_run}.")
-        break
+      # Persistir a disco solo al terminar correctamente, no en cada batch
+      if f is not None:
+        f.flush()
+        os.fsync(f.fileno())
+      completed = True
+    finally:
+      # Fallo o parada (SIGTERM): guardar el progreso que sí llegó al archivo
+      if not completed and current_skip != saved_skip:
+        try:
+          f.flush()
+          save_state(current_skip)
+        except (IOError, ValueError) as e:
+          logging.error(f"Can't flush progress for 'skip' {current_skip}. Error: {e}")
+
+      for task in pending:
+        task.cancel()
+      await asyncio.gather(*pending, return_exceptions=True)
+
+      if f is not None:
+        f.close()
 
   logging.info("Extraction completed successfully. Reset 'skip' to 0 for next day.")
   save_state(0)
 
   if processed_count_in_run > 0:
     try:
-      r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+      r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0)
       r.ping()
 
-      message_data = json.dumps({"raw_file": output_filename})
-      r.publish("channel:phase1_complete", message_data)
+      message_data = orjson.dumps({"raw_file": output_filename})
+      r.xadd(PHASE1_STREAM, {'data': message_data})
 
-      logging.info(f"Message published on 'channel:phase1_complete': {output_filename}")
+      logging.info(f"Message added on '{PHASE1_STREAM}': {output_filename}")
     except Exception as e:
-      logging.error(f"Error publishing on Redis {e}")
+      logging.error(f"Error adding message on Redis {e}")
   else:
-    logging.info("No new records were processed, no publish on Redis.")
+    logging.info("No new records were processed, no message on Redis.")
 
   return True
 
+def handle_sigterm(signum, frame):
+  # Se trata como una parada manual para que run_extraction guarde el progreso
+  raise KeyboardInterrupt
+
 def main():
+  signal.signal(signal.SIGTERM, handle_sigterm)
+
   while True:
     try:
-      success = run_extraction()
+      success = asyncio.run(run_extraction())
       if success:
         logging.info(f"Extraction cycle success. Sleep for {SLEEP_INTERVAL} seconds...")
       else:
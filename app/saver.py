@@ -1,13 +1,20 @@
 import os
-import json
+import gzip
 import redis
-import time
+import redis.asyncio as aioredis
+import socket
 import logging
-import pandas as pd
-import paramiko
+import orjson
+import asyncio
+import asyncssh
+import uvloop
 import traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from sqlalchemy import create_engine, text
+from itertools import repeat
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.pool import QueuePool
 
 # --- Configuración de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -15,10 +22,55 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Constantes ---
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+PHASE2_STREAM = 'stream:phase2_complete'
+STREAM_READ_COUNT = 32
+STREAM_BLOCK_MS = 5000
+# Grupo de consumidores: cada mensaje queda pendiente hasta el XACK (entrega al menos una vez)
+PHASE2_GROUP = 'savers'
+CONSUMER_NAME = os.getenv('CONSUMER_NAME', socket.gethostname())
+# Pendientes de otro consumidor sin XACK durante este tiempo se reclaman al arrancar
+STREAM_CLAIM_IDLE_MS = 60000
+# Entregas de un mensaje cuya carga falla antes de descartarlo
+STREAM_MAX_DELIVERIES = 5
 
 # Base de datos (Sqlite)
 DB_PATH = '/app/database/data.db'
-DB_ENGINE = create_engine(f'sqlite:///{DB_PATH}')
+DB_ENGINE = create_engine(
+  f'sqlite:///{DB_PATH}',
+  connect_args={"check_same_thread": False, "timeout": 30},
+  poolclass=QueuePool,
+  pool_size=5,
+  max_overflow=10,
+  pool_pre_ping=True
+)
+
+# Lecturas vía memoria mapeada (256 MiB)
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+# PRAGMAs aplicados a cada conexión nueva del pool
+SQLITE_PRAGMAS = (
+  "PRAGMA journal_mode=WAL",
+  "PRAGMA synchronous=NORMAL",
+  "PRAGMA temp_store=MEMORY",
+  "PRAGMA cache_size=-64000",
+  f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}",
+)
+
+@event.listens_for(DB_ENGINE, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+  # pysqlite maneja las transacciones por su cuenta y rompe los SAVEPOINT;
+  # se desactiva y SQLAlchemy emite el BEGIN (ver evento "begin")
+  dbapi_connection.isolation_level = None
+  cursor = dbapi_connection.cursor()
+  try:
+    for pragma in SQLITE_PRAGMAS:
+      cursor.execute(pragma)
+  finally:
+    cursor.close()
+
+@event.listens_for(DB_ENGINE, "begin")
+def do_begin(conn):
+  conn.exec_driver_sql("BEGIN")
 
 # SFTP config
 SFTP_HOST = os.getenv('SFTP_HOST', 'sftp')
@@ -26,6 +78,19 @@ SFTP_PORT = int(os.getenv('SFTP_PORT', 22))
 SFTP_USER = os.getenv('SFTP_USER', 'sftp_user')
 SFTP_KEY_PATH = '/app/ssh_keys/id_rsa'
 SFTP_REMOTE_DIR = '/upload'
+# 128 KiB por escritura (OpenSSH acepta hasta 256 KiB por mensaje SFTP)
+SFTP_BLOCK_SIZE = 2 ** 17
+SFTP_MAX_REQUESTS = 128
+# AES-GCM primero (usa AES-NI vía OpenSSL); el resto como respaldo
+SFTP_ENCRYPTION_ALGS = ['aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr']
+SFTP_KEEPALIVE_INTERVAL = 30
+
+# Conexión SFTP persistente entre runs (vive en el bucle de main): el handshake SSH
+# y la autenticación se pagan una vez
+_SFTP_STATE = {'conn': None, 'sftp': None}
+
+# Tamaño de lote para la carga en la DB
+READ_CHUNK_SIZE = 10000
 
 FILE_TO_TABLE_MAP = {
   'raw_file': 'raw_users',
@@ -33,180 +98,504 @@ FILE_TO_TABLE_MAP = {
   'dlq_file': 'invalid_users'
 }
 
+# Tablas de usuarios creadas y migradas al esquema actual (se comprueba una vez por proceso)
+_USER_TABLES_READY = False
+
+# Un solo escritor en Sqlite: las cargas de los hilos se serializan aquí
+_DB_WRITE_LOCK = threading.Lock()
+
+# Esquema fijo de las tablas de usuarios (campos de dummyjson + los que añade el transformer).
+# Los dict/list se guardan como texto JSON. NUMERIC mantiene los enteros como enteros.
+USER_COLUMNS = (
+  ('id', 'INTEGER'),
+  ('firstName', 'TEXT'),
+  ('lastName', 'TEXT'),
+  ('maidenName', 'TEXT'),
+  ('age', 'NUMERIC'),
+  ('gender', 'TEXT'),
+  ('email', 'TEXT'),
+  ('phone', 'TEXT'),
+  ('username', 'TEXT'),
+  ('password', 'TEXT'),
+  ('birthDate', 'TEXT'),
+  ('image', 'TEXT'),
+  ('bloodGroup', 'TEXT'),
+  ('height', 'REAL'),
+  ('weight', 'REAL'),
+  ('eyeColor', 'TEXT'),
+  ('hair', 'TEXT'),
+  ('ip', 'TEXT'),
+  ('address', 'TEXT'),
+  ('macAddress', 'TEXT'),
+  ('university', 'TEXT'),
+  ('bank', 'TEXT'),
+  ('company', 'TEXT'),
+  ('ein', 'TEXT'),
+  ('ssn', 'TEXT'),
+  ('userAgent', 'TEXT'),
+  ('crypto', 'TEXT'),
+  ('role', 'TEXT'),
+  ('department_code', 'TEXT'),
+  ('error_reason', 'TEXT'),
+  ('raw_line', 'TEXT'),
+)
+USER_COLUMN_NAMES = [name for name, _ in USER_COLUMNS]
+
+def build_create_table_sql(table_name):
+  columns = ', '.join(f'"{name}" {sql_type}' for name, sql_type in USER_COLUMNS)
+  return f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns}, "insertion_date" TEXT)'
+
+def build_insert_sql(table_name):
+  quoted_columns = ', '.join(f'"{name}"' for name in USER_COLUMN_NAMES + ['insertion_date'])
+  placeholders = ', '.join('?' * (len(USER_COLUMN_NAMES) + 1))
+  return f'INSERT INTO "{table_name}" ({quoted_columns}) VALUES ({placeholders})'
+
+# SQL generado una sola vez: sin reflexión del esquema en cada run
+TABLE_CREATE_SQL = {table_name: build_create_table_sql(table_name) for table_name in FILE_TO_TABLE_MAP.values()}
+TABLE_INSERT_SQL = {table_name: build_insert_sql(table_name) for table_name in FILE_TO_TABLE_MAP.values()}
+
+# Columnas indexadas por tabla (filtros de la API)
+TABLE_INDEXES = {
+  'processed_users': ['insertion_date']
+}
+
+def to_row(record, columns, insertion_date):
+  # Los valores dict/list se guardan como texto JSON; el resto tal cual
+  values = (record.get(col) for col in columns)
+  return tuple(
+    orjson.dumps(value).decode() if isinstance(value, (dict, list)) else value
+    for value in values
+  ) + (insertion_date,)
+
+def iter_jsonl_batches(filepath, batch_size=READ_CHUNK_SIZE):
+  # Lee el .jsonl(.gz) línea a línea y devuelve listas de como máximo batch_size registros
+  # (memoria acotada a un lote, sea cual sea el tamaño del archivo)
+  opener = gzip.open if filepath.endswith('.gz') else open
+  loads = orjson.loads
+  with opener(filepath, 'rb') as f:
+    batch = []
+    append = batch.append
+    for line in f:
+      # isspace() no crea una copia de la línea como strip()
+      if line.isspace():
+        continue
+      append(loads(line))
+      if len(batch) >= batch_size:
+        yield batch
+        batch = []
+        append = batch.append
+    if batch:
+      yield batch
+
+def _stat_or_none(path):
+  # Un solo stat() en lugar de exists() + getsize(); None si no hay ruta o no existe
+  try:
+    return os.stat(path)
+  except (FileNotFoundError, TypeError):
+    return None
+
+def iter_jsonl_rows(filepath, table_name, insertion_date):
+  dropped_columns = set()
+
+  # Leer el .jsonl por lotes: en memoria nunca hay más de un lote
+  for batch in iter_jsonl_batches(filepath):
+    dropped_columns.update(key for record in batch for key in record if key not in USER_COLUMN_NAMES)
+    yield map(to_row, batch, repeat(USER_COLUMN_NAMES), repeat(insertion_date))
+
+  if dropped_columns:
+    logging.warning(f"Columns not in table '{table_name}' were skipped: {sorted(dropped_columns)}")
+
+def is_file_loaded(dbapi_conn, filepath):
+  cursor = dbapi_conn.driver_connection.cursor()
+  try:
+    return cursor.execute("SELECT 1 FROM etl_loaded_files WHERE filepath = ?", (filepath,)).fetchone() is not None
+  finally:
+    cursor.close()
+
+def load_rows_to_table(dbapi_conn, row_batches, table_name, filepath):
+  insert_sql = TABLE_INSERT_SQL[table_name]
+  row_batches = iter(row_batches)
+
+  # El primer lote se lee fuera del lock (se solapa con la escritura de otro hilo).
+  # Sqlite admite un solo escritor: los hilos esperan en el lock del proceso, sin límite,
+  # en lugar de agotar el busy timeout y perder la tabla con 'database is locked'
+  first_rows = next(row_batches, None)
+  with _DB_WRITE_LOCK:
+    cursor = dbapi_conn.driver_connection.cursor()
+    try:
+      cursor.execute("BEGIN IMMEDIATE")
+      # Se marca en la misma transacción: o se cargan las filas y la marca, o nada
+      cursor.execute(
+        "INSERT INTO etl_loaded_files (filepath, table_name, loaded_at) VALUES (?, ?, ?)",
+        (filepath, table_name, datetime.now().isoformat())
+      )
+      if first_rows is not None:
+        cursor.executemany(insert_sql, first_rows)
+      for rows in row_batches:
+        cursor.executemany(insert_sql, rows)
+      dbapi_conn.commit()
+    except BaseException:
+      dbapi_conn.rollback()
+      raise
+    finally:
+      cursor.close()
+
+def load_one_file(key, table_name, filepath):
+  # True: tabla cargada; False: no había nada que cargar; None: la carga falló
+  # --- Validación del archivo ---
+  if not filepath:
+    logging.warning(f"Key '{key}' not found on the message. Skipping.")
+    return False
+  st = _stat_or_none(filepath)
+  if st is None:
+    logging.warning(f"File not found: {filepath}. Skip saving on DB.")
+    return False
+  if st.st_size == 0:
+    logging.info(f"File empty: {filepath}. Skip saving on DB.")
+    return False
+
+  # Una sola marca de tiempo por archivo (nunca datetime.now() dentro del bucle de filas)
+  insertion_date = datetime.now().isoformat()
+
+  # Conexión propia del hilo (sale del pool con los PRAGMAs ya aplicados); un commit por archivo
+  dbapi_conn = DB_ENGINE.raw_connection()
+  try:
+    # Un reintento del mensaje no vuelve a cargar los archivos que ya entraron
+    if is_file_loaded(dbapi_conn, filepath):
+      logging.info(f"{filepath} already loaded on table '{table_name}'. Skipping.")
+      return False
+
+    logging.info(f"Loading {filepath} on table '{table_name}'...")
+    load_rows_to_table(dbapi_conn, iter_jsonl_rows(filepath, table_name, insertion_date), table_name, filepath)
+
+    logging.info(f"Table '{table_name}' saved successfully.")
+
+  except Exception as e:
+    logging.error(f"Error saving table '{table_name}' from {filepath}: {e}")
+    logging.error(traceback.format_exc())
+    return None
+  finally:
+    dbapi_conn.close()
+  return True
+
+def migrate_user_table(conn, table_name):
+  # Las tablas creadas por versiones anteriores (esquema inferido por pandas) no tienen todas
+  # las columnas del INSERT fijo: se añaden las que falten
+  existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table_name}")')}
+  missing = [(name, sql_type) for name, sql_type in USER_COLUMNS + (('insertion_date', 'TEXT'),) if name not in existing]
+  for name, sql_type in missing:
+    conn.exec_driver_sql(f'ALTER TABLE "{table_name}" ADD COLUMN "{name}" {sql_type}')
+  if missing:
+    logging.warning(f"Table '{table_name}' migrated. Columns added: {[name for name, _ in missing]}")
+
 def save_to_database(filepaths):
+  # Devuelve False si alguna tabla no se pudo cargar (el mensaje no se confirma)
+  global _USER_TABLES_READY
   logging.info("Starting saving on database...")
+  run_timestamp = datetime.now().isoformat()
   os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-  # --- Guardar el resumen de la run ---
   try:
-    with DB_ENGINE.connect() as conn:
-      with conn.begin():  # Iniciar transacción
-        # Crear la tabla si no existe
-        conn.execute(text("""
-          CREATE TABLE IF NOT EXISTS etl_runs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            run_timestamp TEXT,
-            raw_file TEXT,
-            processed_file TEXT,
-            dlq_file TEXT,
-            valid_count INTEGER,
-            invalid_count INTEGER
-          );
-        """))
-          
-        # Insertar el registro de esta run
-        conn.execute(text("""
-          INSERT INTO etl_runs (run_timestamp, raw_file, processed_file, dlq_file, valid_count, invalid_count)
-          VALUES (:ts, :rf, :pf, :df, :vc, :ic)
-        """), {
-          "ts": datetime.now().isoformat(),
-          "rf": filepaths.get('raw_file'),
-          "pf": filepaths.get('processed_file'),
-          "df": filepaths.get('dlq_file'),
-          "vc": filepaths.get('valid_count'),
-          "ic": filepaths.get('invalid_count')
-        })
+    # --- Guardar el resumen de la run ---
+    with DB_ENGINE.begin() as conn:
+      # Crear la tabla si no existe
+      conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS etl_runs (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          run_timestamp TEXT,
+          raw_file TEXT,
+          processed_file TEXT,
+          dlq_file TEXT,
+          valid_count INTEGER,
+          invalid_count INTEGER
+        );
+      """))
+      # La API ordena por run_timestamp: el índice evita el sort
+      conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_etl_runs_ts ON etl_runs(run_timestamp DESC)")
+      conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS idx_etl_runs_processed ON etl_runs(processed_file)")
+
+      # Archivos ya cargados en su tabla: al reintentar un mensaje solo se cargan los que fallaron
+      conn.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS etl_loaded_files (
+          filepath TEXT PRIMARY KEY,
+          table_name TEXT,
+          loaded_at TEXT
+        )
+      """)
+
+      # Tablas de usuarios con su esquema explícito y sus índices (una vez por proceso)
+      if not _USER_TABLES_READY:
+        for table_name, create_sql in TABLE_CREATE_SQL.items():
+          conn.exec_driver_sql(create_sql)
+          migrate_user_table(conn, table_name)
+          for column in TABLE_INDEXES.get(table_name, []):
+            conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_{column}" ON "{table_name}"("{column}")')
+
+      # Insertar el registro de esta run (una sola vez por mensaje, aunque se reintente)
+      conn.exec_driver_sql(
+        "INSERT INTO etl_runs (run_timestamp, raw_file, processed_file, dlq_file, valid_count, invalid_count) "
+        "SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM etl_runs WHERE processed_file = ?)",
+        [(
+          run_timestamp,
+          filepaths.get('raw_file'),
+          filepaths.get('processed_file'),
+          filepaths.get('dlq_file'),
+          filepaths.get('valid_count'),
+          filepaths.get('invalid_count'),
+          filepaths.get('processed_file')
+        )]
+      )
+    _USER_TABLES_READY = True
     logging.info("'etl_runs' record saved successfully.")
-  except Exception as e:
-    logging.error(f"Critical error saving on 'etl_runs': {e}")
-    logging.error(traceback.format_exc())
-    return
 
-  # --- Guardar cada archivo ---
-  for key, table_name in FILE_TO_TABLE_MAP.items():
-    filepath = filepaths.get(key)
+    # --- Guardar cada archivo ---
+    # Tablas independientes: un hilo y una transacción por archivo. Sqlite (WAL) sigue
+    # admitiendo un solo escritor, pero el parseo de un archivo se solapa con la escritura de otro.
+    with ThreadPoolExecutor(max_workers=len(FILE_TO_TABLE_MAP)) as load_executor:
+      loaded = list(load_executor.map(
+        load_one_file,
+        FILE_TO_TABLE_MAP.keys(),
+        FILE_TO_TABLE_MAP.values(),
+        [filepaths.get(key) for key in FILE_TO_TABLE_MAP]
+      ))
 
-    # --- Validación del archivo ---
-    if not filepath:
-        logging.warning(f"Key '{key}' not found on the message. Skipping.")
-        continue
-    if not os.path.exists(filepath):
-        logging.warning(f"File not found: {filepath}. Skip saving on DB.")
-        continue
-    if os.path.getsize(filepath) == 0:
-        logging.info(f"File empty: {filepath}. Skip saving on DB.")
-        continue
+    # Actualizar estadísticas para el planificador tras la carga (muestreo acotado)
+    if any(loaded):
+      with _DB_WRITE_LOCK, DB_ENGINE.begin() as conn:
+        conn.exec_driver_sql("PRAGMA analysis_limit=1000")
+        conn.exec_driver_sql("ANALYZE")
 
-    # --- Inicio de la transacción para este archivo ---
-    try:
-      logging.info(f"Loading {filepath} on table '{table_name}'...")
-      
-      # Leer el .jsonl
-      df = pd.read_json(filepath, lines=True)
-
-      # Aplanar tipos complejos
-      for col in df.columns:
-        if df[col].dtype == 'object':
-          df[col] = df[col].apply(lambda x: json.dumps(x) if isinstance(x, (dict, list)) else x)
-
-      # Añadir columna de inserción
-      df['insertion_date'] = datetime.now().isoformat()
-      
-      # Subir a Sqlite
-      with DB_ENGINE.connect() as conn:
-        with conn.begin():
-          df.to_sql(table_name, con=conn, if_exists='append', index=False)
-      
-      logging.info(f"Table '{table_name}' saved successfully.")
+  except Exception as e:
+    logging.error(f"Critical error saving on database: {e}")
+    logging.error(traceback.format_exc())
+    return False
 
-    except Exception as e:
-      logging.error(f"Error saving table '{table_name}' from {filepath}: {e}")
-      logging.error(traceback.format_exc())
+  if None in loaded:
+    logging.error("Database save cycle finished with failed tables.")
+    return False
 
   logging.info("Database save cycle completed.")
+  return True
 
 
-def upload_to_sftp(filepaths):
-  logging.info("Starting upload to SFTP...")
-  
-  sftp = None
-  transport = None
+async def upload_file_to_sftp(sftp, local_path, remote_path):
+  logging.info(f"Uploading {local_path} a {remote_path}...")
+  # Bloques grandes y muchas escrituras en vuelo para no esperar el ACK de cada bloque
+  await sftp.put(local_path, remote_path, block_size=SFTP_BLOCK_SIZE, max_requests=SFTP_MAX_REQUESTS)
+
+async def _get_sftp():
+  # Reutiliza la conexión de runs anteriores mientras siga viva (el keepalive cierra las caídas)
+  conn = _SFTP_STATE['conn']
+  if conn is not None and not conn.is_closed():
+    return _SFTP_STATE['sftp']
+  _SFTP_STATE.update(conn=None, sftp=None)
+
   max_retries = 5
-  
   for attempt in range(max_retries):
     try:
-      private_key = paramiko.RSAKey.from_private_key_file(SFTP_KEY_PATH)
-      transport = paramiko.Transport((SFTP_HOST, SFTP_PORT))
-      transport.connect(username=SFTP_USER, pkey=private_key)
-      sftp = paramiko.SFTPClient.from_transport(transport)
+      conn = await asyncssh.connect(
+        SFTP_HOST,
+        port=SFTP_PORT,
+        username=SFTP_USER,
+        client_keys=[SFTP_KEY_PATH],
+        known_hosts=None,
+        encryption_algs=SFTP_ENCRYPTION_ALGS,
+        keepalive_interval=SFTP_KEEPALIVE_INTERVAL,
+        keepalive_count_max=3
+      )
+      sftp = await conn.start_sftp_client()
       logging.info(f"Connect to SFTP on {SFTP_HOST}:{SFTP_PORT} (Try {attempt+1})")
-      break
-    except Exception as e:
+      _SFTP_STATE.update(conn=conn, sftp=sftp)
+      return sftp
+    except (OSError, asyncssh.Error) as e:
       logging.warning(f"Try {attempt+1}/{max_retries} failed. Cannot connect to SFTP: {e}. Retry in 5s...")
-      if transport:
-        transport.close()
       if attempt + 1 == max_retries:
         logging.error("All SFTP connection attempts failed. Aborting upload.")
-        return
-      time.sleep(5)
-          
-  if not sftp:
-    logging.error("Unexpected fail, connection to SFTP is not active.")
+        return None
+      await asyncio.sleep(5)
+
+def _reset_sftp():
+  conn = _SFTP_STATE['conn']
+  _SFTP_STATE.update(conn=None, sftp=None)
+  if conn is not None:
+    conn.close()
+
+async def upload_to_sftp_async(filepaths):
+  logging.info("Starting upload to SFTP...")
+
+  files_to_upload = [
+    filepaths.get('raw_file'),
+    filepaths.get('processed_file'),
+    filepaths.get('dlq_file')
+  ]
+
+  uploads = []
+  for local_path in files_to_upload:
+    if _stat_or_none(local_path) is None:
+      logging.warning(f"File not found or null: {local_path}. Skip upload to SFTP.")
+      continue
+
+    remote_filename = os.path.basename(local_path)
+    uploads.append((local_path, f"{SFTP_REMOTE_DIR}/{remote_filename}"))
+
+  if not uploads:
+    logging.warning("No files to upload to SFTP.")
+    return
+
+  sftp = await _get_sftp()
+  if sftp is None:
     return
 
   try:
-    files_to_upload = [
-      filepaths.get('raw_file'),
-      filepaths.get('processed_file'),
-      filepaths.get('dlq_file')
-    ]
-    
-    for local_path in files_to_upload:
-      if not local_path or not os.path.exists(local_path):
-        logging.warning(f"File not found or null: {local_path}. Skip upload to SFTP.")
-        continue
-          
-      remote_filename = os.path.basename(local_path)
-      remote_path = f"{SFTP_REMOTE_DIR}/{remote_filename}"
-      logging.info(f"Uploading {local_path} a {remote_path}...")
-      sftp.put(local_path, remote_path)
-        
+    # Subir los archivos en paralelo sobre la misma conexión
+    results = await asyncio.gather(
+      *(upload_file_to_sftp(sftp, local_path, remote_path) for local_path, remote_path in uploads),
+      return_exceptions=True
+    )
+
+    for (local_path, _), result in zip(uploads, results):
+      if isinstance(result, Exception):
+        logging.error(f"Error uploading {local_path} to SFTP: {result}")
+        # Un error que no es del propio archivo (canal o conexión rotos): reconectar en la próxima run
+        if not isinstance(result, asyncssh.SFTPError):
+          _reset_sftp()
+
     logging.info("Upload to SFTP complete.")
-      
+
   except Exception as e:
     logging.error(f"Error during SFTP upload (after connecting): {e}")
-  finally:
-    if sftp:
-      sftp.close()
-    if transport:
-      transport.close()
+    _reset_sftp()
+
+async def handle_message(message):
+  # Devuelve False si la carga en la DB falló: el mensaje queda pendiente para reintentarlo
+  filepaths = orjson.loads(message)
+  if not isinstance(filepaths, dict):
+    raise ValueError(f"expected a JSON object, got {type(filepaths).__name__}")
+  logging.info(f"Message recieved. Start saving for: {filepaths.get('raw_file')}")
+
+  # DB local (en un hilo) y SFTP remoto (en el bucle) no comparten recursos: se ejecutan a la vez
+  results = await asyncio.gather(
+    asyncio.to_thread(save_to_database, filepaths),
+    upload_to_sftp_async(filepaths),
+    return_exceptions=True
+  )
+  for name, result in zip(('database', 'sftp'), results):
+    if isinstance(result, Exception):
+      logging.error(f"Unexpected error in {name} step: {result}")
+      logging.error(''.join(traceback.format_exception(result)))
+
+  logging.info("Save cycle complete.")
+  return results[0] is True
+
+async def ensure_consumer_group(r):
+  try:
+    # id='0': el grupo también recibe lo publicado antes de crearlo
+    await r.xgroup_create(PHASE2_STREAM, PHASE2_GROUP, id='0', mkstream=True)
+    logging.info(f"Consumer group '{PHASE2_GROUP}' created on '{PHASE2_STREAM}'.")
+  except redis.exceptions.ResponseError as e:
+    # BUSYGROUP: el grupo ya existe
+    if 'BUSYGROUP' not in str(e):
+      raise
 
-def main():
+async def delivery_count(r, message_id):
+  pending = await r.xpending_range(PHASE2_STREAM, PHASE2_GROUP, min=message_id, max=message_id, count=1)
+  return pending[0]['times_delivered'] if pending else 0
+
+async def process_entries(r, messages):
+  # Devuelve cuántos mensajes quedan pendientes para reintentar
+  done_ids = []
+  for message_id, fields in messages:
+    try:
+      if not await handle_message(fields[b'data']):
+        # La carga falló: sin XACK, se reintenta (hasta STREAM_MAX_DELIVERIES entregas)
+        deliveries = await delivery_count(r, message_id)
+        if deliveries < STREAM_MAX_DELIVERIES:
+          logging.warning(f"Message {message_id} failed (delivery {deliveries}/{STREAM_MAX_DELIVERIES}). It will be retried.")
+          continue
+        logging.error(f"Message {message_id} failed {deliveries} times. Discarding; its files stay on disk.")
+    except (ValueError, KeyError, TypeError) as e:
+      # Mensaje mal formado (o ya borrado del stream): se descarta para no reintentarlo para siempre
+      logging.error(f"Invalid message {message_id}: {e}. Discarding.")
+    done_ids.append(message_id)
+
+  # Confirmar y borrar solo después de procesar: si el servicio se cae antes, el mensaje sigue pendiente
+  if done_ids:
+    await r.xack(PHASE2_STREAM, PHASE2_GROUP, *done_ids)
+    await r.xdel(PHASE2_STREAM, *done_ids)
+  return len(messages) - len(done_ids)
+
+async def process_own_pending(r):
+  # Historial de este consumidor: entregados y sin XACK (reinicio o carga fallida).
+  # Se avanza por id para no volver a leer en el mismo pase lo que sigue pendiente
+  left_pending = 0
+  last_id = '0'
+  while True:
+    entries = await r.xreadgroup(PHASE2_GROUP, CONSUMER_NAME, {PHASE2_STREAM: last_id}, count=STREAM_READ_COUNT)
+    if not entries or not entries[0][1]:
+      return left_pending
+    messages = entries[0][1]
+    left_pending += await process_entries(r, messages)
+    last_id = messages[-1][0]
+
+async def claim_pending(r):
+  # Pendientes de este consumidor (reinicio del servicio)
+  left_pending = await process_own_pending(r)
+
+  # Pendientes de consumidores caídos (p. ej. un contenedor recreado con otro hostname)
+  start_id = '0-0'
+  while True:
+    # Redis 6.2 devuelve [next_id, mensajes]; Redis 7 añade los ids ya borrados
+    start_id, messages = (await r.xautoclaim(
+      PHASE2_STREAM, PHASE2_GROUP, CONSUMER_NAME,
+      min_idle_time=STREAM_CLAIM_IDLE_MS, start_id=start_id, count=STREAM_READ_COUNT
+    ))[:2]
+    if messages:
+      logging.info(f"Claimed {len(messages)} pending messages from other consumers.")
+      left_pending += await process_entries(r, messages)
+    if start_id in (b'0-0', '0-0'):
+      return left_pending
+
+async def main():
   logging.info("Starting 'Saver' service...")
-  time.sleep(5)
+  await asyncio.sleep(5)
 
   r = None
   while r is None:
     try:
-      r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
-      r.ping()
+      # Sin decode_responses: los payloads llegan como bytes y van directos a orjson
+      client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, socket_keepalive=True)
+      await client.ping()
+      r = client
       logging.info("Connection with Redis set.")
     except redis.exceptions.ConnectionError as e:
       logging.warning(f"Cannot connect with Redis: {e}. Retrying in 5s...")
-      time.sleep(5)
+      await asyncio.sleep(5)
 
   while True:
     try:
-      p = r.pubsub()
-      p.subscribe("channel:phase2_complete")
-      logging.info("Suscribed to 'channel:phase2_complete'. Waiting messages...")
+      await ensure_consumer_group(r)
+      # Primero lo que quedó sin confirmar de una ejecución anterior
+      left_pending = await claim_pending(r)
+
+      logging.info(f"Waiting messages on '{PHASE2_STREAM}'...")
 
-      for message in p.listen():
-        if message['type'] == 'message':
-          filepaths = json.loads(message['data'])
-          logging.info(f"Message recieved. Start saving for: {filepaths.get('raw_file')}")
+      while True:
+        entries = await r.xreadgroup(PHASE2_GROUP, CONSUMER_NAME, {PHASE2_STREAM: '>'}, count=STREAM_READ_COUNT, block=STREAM_BLOCK_MS)
+        for _, messages in entries or []:
+          left_pending += await process_entries(r, messages)
 
-          save_to_database(filepaths)
-          upload_to_sftp(filepaths)
+        # Sin mensajes nuevos: reintentar las cargas fallidas que siguen pendientes
+        if not entries and left_pending:
+          left_pending = await process_own_pending(r)
 
-          logging.info("Save cycle complete.")
-    
     except redis.exceptions.ConnectionError as e:
       logging.error(f"Connection error on Redis: {e}. Retry in 10s...")
-      time.sleep(10)
+      await asyncio.sleep(10)
     except Exception as e:
       logging.error(f"Unexpected error: {e}. Restart in 10s...")
-      time.sleep(10)
+      await asyncio.sleep(10)
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  # uvloop como bucle de eventos (Redis, SFTP y la espera de la carga en la DB)
+  asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+  asyncio.run(main())
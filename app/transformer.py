@@ -1,12 +1,14 @@
+import csv
 import os
-import json
+import re
+import gzip
+import orjson
 import redis
+import socket
 import time
 import logging
-import pandas as pd
-from datetime import datetime
-from jsonschema import validate, exceptions
-from email_validator import validate_email, EmailNotValidError
+import traceback
+import fastjsonschema
 
 # --- Configuración de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -14,9 +16,21 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Variables de Entorno ---
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+PHASE1_STREAM = 'stream:phase1_complete'
+PHASE2_STREAM = 'stream:phase2_complete'
+STREAM_READ_COUNT = 32
+STREAM_BLOCK_MS = 5000
+# Grupo de consumidores: cada mensaje queda pendiente hasta el XACK (entrega al menos una vez)
+PHASE1_GROUP = 'transformers'
+CONSUMER_NAME = os.getenv('CONSUMER_NAME', socket.gethostname())
+# Pendientes de otro consumidor sin XACK durante este tiempo se reclaman al arrancar
+STREAM_CLAIM_IDLE_MS = 60000
+# Entregas de un mensaje cuyo procesamiento falla antes de descartarlo
+STREAM_MAX_DELIVERIES = 5
 LOOKUP_FILE = 'data/lookup/departments.csv'
 PROCESSED_DIR = 'data/processed_users'
 DLQ_DIR = 'data/dlq'
+WRITE_BUFFER_SIZE = 1 << 20
 
 # --- Esquema de Validación ---
 USER_SCHEMA = {
@@ -39,66 +53,178 @@ USER_SCHEMA = {
 
 def load_department_lookup(filepath):
   try:
-    df = pd.read_csv(filepath)
-    return pd.Series(df.department_code.values, index=df.department_name).to_dict()
+    # CSV pequeño de dos columnas: csv de la stdlib, por nombre de columna como antes
+    with open(filepath, newline='') as f:
+      return {row['department_name']: row['department_code'] for row in csv.DictReader(f)}
   except Exception as e:
     logging.error(f"Error loading lookup file {filepath}: {e}")
     return {}
   
+# Formato de email simple (usuario@dominio.tld), evaluado dentro del mismo validador
+EMAIL_REGEX = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# Validador generado una sola vez (código Python específico para este esquema)
+USER_VALIDATOR = fastjsonschema.compile(USER_SCHEMA, formats={"email": EMAIL_REGEX.fullmatch})
+
+# VALIDATOR_DEBUG=1 valida con fastjsonschema (auditoría de la versión escrita a mano)
+VALIDATOR_DEBUG = os.getenv('VALIDATOR_DEBUG', '0') == '1'
+
+USER_REQUIRED = tuple(sorted(USER_SCHEMA['required']))
+
+def validate_schema(record, _dict=dict, _str=str, _int=int, _float=float, _bool=bool, _isinstance=isinstance, _email=EMAIL_REGEX.fullmatch):
+  # USER_SCHEMA escrito a mano (mismas reglas y mensajes que fastjsonschema); builtins como locales
+  if not _isinstance(record, _dict):
+    return "data must be object"
+  for key in USER_REQUIRED:
+    if key not in record:
+      missing = [key for key in USER_REQUIRED if key not in record]
+      return f"data must contain {missing} properties"
+
+  value = record['id']
+  # Como en JSON Schema, un float sin parte decimal (1.0) también es integer
+  if _isinstance(value, _bool) or not (_isinstance(value, _int) or (_isinstance(value, _float) and value.is_integer())):
+    return "data.id must be integer"
+
+  value = record['firstName']
+  if not _isinstance(value, _str):
+    return "data.firstName must be string"
+  if not value:
+    return "data.firstName must be longer than or equal to 1 characters"
+
+  value = record['email']
+  if not _isinstance(value, _str):
+    return "data.email must be string"
+  if not _email(value):
+    return "data.email must be email"
+
+  value = record['age']
+  if not _isinstance(value, (_int, _float)) or _isinstance(value, _bool):
+    return "data.age must be number"
+  if value < 10:
+    return "data.age must be bigger than or equal to 10"
+  if value > 65:
+    return "data.age must be smaller than or equal to 65"
+
+  value = record['company']
+  if not _isinstance(value, _dict):
+    return "data.company must be object"
+  if 'department' not in value:
+    return "data.company must contain ['department'] properties"
+  value = value['department']
+  if not _isinstance(value, _str):
+    return "data.company.department must be string"
+  if not value:
+    return "data.company.department must be longer than or equal to 1 characters"
+
+  return None
+
 def validate_record(record):
-  try:
-    # Validación de Esquema
-    validate(instance=record, schema=USER_SCHEMA)
-    # Validación de Email
-    validate_email(record['email'], check_deliverability=False)
+  if VALIDATOR_DEBUG:
+    try:
+      USER_VALIDATOR(record)
+      return True, None
+    except fastjsonschema.JsonSchemaValueException as e:
+      return False, f"Schema error: {e.message}"
+    except Exception as e:
+      return False, f"Unexpected validation error: {str(e)}"
 
-    return True, None
-  
-  except exceptions.ValidationError as e:
-    return False, f"Schema error: {e.message}"
-  except EmailNotValidError as e:
-    return False, f"Invalid email: {str(e)}"
+  try:
+    # Validación de Esquema (incluye el formato del email)
+    error = validate_schema(record)
   except Exception as e:
     return False, f"Unexpected validation error: {str(e)}"
+
+  if error:
+    return False, f"Schema error: {error}"
+  return True, None
   
+def open_jsonl(filepath, mode):
+  # Modo binario (orjson trabaja con bytes); los .jsonl.gz se comprimen de forma transparente.
+  # Las escrituras ya llegan agrupadas en bloques de ~1 MiB (ver RecordOutput)
+  opener = gzip.open if filepath.endswith('.gz') else open
+  return opener(filepath, f'{mode}b')
+
+class RecordOutput:
+  # Un destino de registros (.jsonl.gz): las líneas se acumulan y van al archivo
+  # en un solo write() cada ~1 MiB
+  def __init__(self, jsonl_path):
+    self.file = open_jsonl(jsonl_path, 'w')
+    self.buffer = bytearray()
+
+  def write(self, record):
+    self.buffer += orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    if len(self.buffer) >= WRITE_BUFFER_SIZE:
+      self.flush_buffer()
+
+  def flush_buffer(self):
+    if self.buffer:
+      self.file.write(self.buffer)
+      self.buffer.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    try:
+      self.flush_buffer()
+    finally:
+      self.file.close()
+
+def write_record(record, lookup_data, f_processed, f_dlq):
+  is_valid, error_reason = validate_record(record)
+
+  if is_valid:
+    dept_name = record['company']['department']
+    record['department_code'] = lookup_data.get(dept_name, 'UNKNOWN')
+
+    f_processed.write(record)
+  else:
+    record['error_reason'] = error_reason
+    f_dlq.write(record)
+
+  return is_valid
+
+def write_corrupted_line(line, raw_filepath, error, f_dlq):
+  logging.warning(f"Corrupted line in {raw_filepath}: {error}")
+  raw_line = line.decode('utf-8', errors='replace')
+  f_dlq.write({"raw_line": raw_line, "error_reason": "Invalid JSON"})
+
+def process_lines(f_raw, raw_filepath, lookup_data, f_processed, f_dlq):
+  valid_count = 0
+  invalid_count = 0
+
+  for line in f_raw:
+    try:
+      record = orjson.loads(line)
+      if write_record(record, lookup_data, f_processed, f_dlq):
+        valid_count += 1
+      else:
+        invalid_count += 1
+
+    except orjson.JSONDecodeError as e:
+      write_corrupted_line(line, raw_filepath, e, f_dlq)
+      invalid_count += 1
+
+  return valid_count, invalid_count
+
 def process_file(raw_filepath, lookup_data):
   logging.info(f"Processing file: {raw_filepath}")
 
   os.makedirs(PROCESSED_DIR, exist_ok=True)
   os.makedirs(DLQ_DIR, exist_ok=True)
-  timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-  processed_filename = os.path.join(PROCESSED_DIR, f'etl_{timestamp}.jsonl')
-  dlq_filename = os.path.join(DLQ_DIR, f'invalid_users_{timestamp}.jsonl')
-  
-  valid_count = 0
-  invalid_count = 0
+  # Nombres a partir del archivo raw (no de la hora): dos archivos procesados en el mismo
+  # segundo no comparten salida, y reprocesar el mismo raw la reescribe en lugar de duplicarla
+  raw_name = os.path.basename(raw_filepath).split('.')[0]
+  processed_filename = os.path.join(PROCESSED_DIR, f'etl_{raw_name}.jsonl.gz')
+  dlq_filename = os.path.join(DLQ_DIR, f'invalid_users_{raw_name}.jsonl.gz')
 
   try:
-    with open(raw_filepath, 'r', encoding='utf-8') as f_raw, \
-         open(processed_filename, 'a', encoding='utf-8') as f_processed, \
-         open(dlq_filename, 'a', encoding='utf-8') as f_dlq:
-      
-      for line in f_raw:
-        try:
-          record = json.loads(line)
-          is_valid, error_reason = validate_record(record)
-
-          if is_valid:
-            dept_name = record['company']['department']
-            record['department_code'] = lookup_data.get(dept_name, 'UNKNOWN')
-
-            f_processed.write(json.dumps(record) + '\n')
-            valid_count += 1
-          else:
-            record['error_reason'] = error_reason
-            f_dlq.write(json.dumps(record) + '\n')
-            invalid_count += 1
-
-        except json.JSONDecodeError as e:
-          logging.warning(f"Corrupted line in {raw_filepath}: {e}")
-          f_dlq.write(json.dumps({"raw_line": line, "error_reason": "Invalid JSON"}) + '\n')
-          invalid_count += 1
+    with RecordOutput(processed_filename) as f_processed, \
+         RecordOutput(dlq_filename) as f_dlq:
+      with open_jsonl(raw_filepath, 'r') as f_raw:
+        valid_count, invalid_count = process_lines(f_raw, raw_filepath, lookup_data, f_processed, f_dlq)
     
+
     logging.info(f"Process of {raw_filepath} complete. Valids: {valid_count}, invalids: {invalid_count}")
     return processed_filename, dlq_filename, valid_count, invalid_count
 
@@ -106,6 +232,114 @@ def process_file(raw_filepath, lookup_data):
     logging.error(f"I/O error processing {raw_filepath}: {e}")
     return None, None, 0, 0
   
+def handle_message(message, dept_lookup):
+  # Devuelve el mensaje para la fase 2 (o None); se publica junto al resto del lote
+  data = orjson.loads(message)
+  if not isinstance(data, dict):
+    raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+  raw_file = data['raw_file']
+
+  if not os.path.exists(raw_file):
+    logging.error(f"File not found: {raw_file}. Skiping...")
+    return None
+
+  processed_file, dlq_file, valid, invalid = process_file(raw_file, dept_lookup)
+
+  if not processed_file:
+    return None
+  return orjson.dumps({
+    "raw_file": raw_file,
+    "processed_file": processed_file,
+    "dlq_file": dlq_file,
+    "valid_count": valid,
+    "invalid_count": invalid
+  })
+
+def ensure_consumer_group(r):
+  try:
+    # id='0': el grupo también recibe lo publicado antes de crearlo
+    r.xgroup_create(PHASE1_STREAM, PHASE1_GROUP, id='0', mkstream=True)
+    logging.info(f"Consumer group '{PHASE1_GROUP}' created on '{PHASE1_STREAM}'.")
+  except redis.exceptions.ResponseError as e:
+    # BUSYGROUP: el grupo ya existe
+    if 'BUSYGROUP' not in str(e):
+      raise
+
+def delivery_count(r, message_id):
+  pending = r.xpending_range(PHASE1_STREAM, PHASE1_GROUP, min=message_id, max=message_id, count=1)
+  return pending[0]['times_delivered'] if pending else 0
+
+def process_entries(r, messages, dept_lookup):
+  # Devuelve cuántos mensajes quedan pendientes para reintentar
+  done_ids = []
+  results = []
+  for message_id, fields in messages:
+    try:
+      message_data = handle_message(fields[b'data'], dept_lookup)
+      if message_data:
+        results.append(message_data)
+    except (ValueError, KeyError, TypeError) as e:
+      # Mensaje mal formado (o ya borrado del stream): se descarta para no reintentarlo para siempre
+      logging.error(f"Invalid message {message_id}: {e}. Discarding.")
+    except Exception as e:
+      # Fallo al procesar (p. ej. un .jsonl.gz truncado): sin XACK, se reintenta
+      # (hasta STREAM_MAX_DELIVERIES entregas) sin bloquear al resto del lote
+      logging.error(f"Error processing message {message_id}: {e}")
+      logging.error(traceback.format_exc())
+      deliveries = delivery_count(r, message_id)
+      if deliveries < STREAM_MAX_DELIVERIES:
+        logging.warning(f"Message {message_id} failed (delivery {deliveries}/{STREAM_MAX_DELIVERIES}). It will be retried.")
+        continue
+      logging.error(f"Message {message_id} failed {deliveries} times. Discarding.")
+    done_ids.append(message_id)
+
+  if not done_ids:
+    return len(messages)
+
+  # Un solo round-trip por lote: primero los XADD de la fase 2 y después el XACK/XDEL.
+  # Si el servicio se cae antes, los mensajes siguen pendientes y se reprocesan
+  pipe = r.pipeline(transaction=False)
+  for message_data in results:
+    pipe.xadd(PHASE2_STREAM, {'data': message_data})
+  pipe.xack(PHASE1_STREAM, PHASE1_GROUP, *done_ids)
+  pipe.xdel(PHASE1_STREAM, *done_ids)
+  pipe.execute()
+
+  if results:
+    logging.info(f"{len(results)} messages added on '{PHASE2_STREAM}'")
+  return len(messages) - len(done_ids)
+
+def process_own_pending(r, dept_lookup):
+  # Historial de este consumidor: entregados y sin XACK (reinicio o procesamiento fallido).
+  # Se avanza por id para no volver a leer en el mismo pase lo que sigue pendiente
+  left_pending = 0
+  last_id = '0'
+  while True:
+    entries = r.xreadgroup(PHASE1_GROUP, CONSUMER_NAME, {PHASE1_STREAM: last_id}, count=STREAM_READ_COUNT)
+    if not entries or not entries[0][1]:
+      return left_pending
+    messages = entries[0][1]
+    left_pending += process_entries(r, messages, dept_lookup)
+    last_id = messages[-1][0]
+
+def claim_pending(r, dept_lookup):
+  # Pendientes de este consumidor (reinicio del servicio)
+  left_pending = process_own_pending(r, dept_lookup)
+
+  # Pendientes de consumidores caídos (p. ej. un contenedor recreado con otro hostname)
+  start_id = '0-0'
+  while True:
+    # Redis 6.2 devuelve [next_id, mensajes]; Redis 7 añade los ids ya borrados
+    start_id, messages = r.xautoclaim(
+      PHASE1_STREAM, PHASE1_GROUP, CONSUMER_NAME,
+      min_idle_time=STREAM_CLAIM_IDLE_MS, start_id=start_id, count=STREAM_READ_COUNT
+    )[:2]
+    if messages:
+      logging.info(f"Claimed {len(messages)} pending messages from other consumers.")
+      left_pending += process_entries(r, messages, dept_lookup)
+    if start_id in (b'0-0', '0-0'):
+      return left_pending
+
 def main():
   logging.info("Starting 'transformer' service...")
 
@@ -113,7 +347,8 @@ def main():
   r = None
   while r is None:
     try:
-      r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+      # Sin decode_responses: los payloads llegan como bytes y van directos a orjson
+      r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, socket_keepalive=True)
       r.ping()
       logging.info("Connection with Redis set.")
     except redis.exceptions.ConnectionError as e:
@@ -127,33 +362,21 @@ def main():
   
   while True:
     try:
-      # r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
-      p = r.pubsub()
-      p.subscribe("channel:phase1_complete")
-      logging.info("Subscribe to 'channel:phase1_complete'. Waiting messages")
-
-      for message in p.listen():
-        if message['type'] == 'message':
-          data = json.loads(message['data'])
-          raw_file = data['raw_file']
-
-          if not os.path.exists(raw_file):
-            logging.error(f"File not found: {raw_file}. Skiping...")
-            continue
-
-          processed_file, dlq_file, valid, invalid = process_file(raw_file, dept_lookup)
-
-          if processed_file:
-            message_data = json.dumps({
-              "raw_file": raw_file,
-              "processed_file": processed_file,
-              "dlq_file": dlq_file,
-              "valid_count": valid,
-              "invalid_count": invalid
-            })
-            r.publish("channel:phase2_complete", message_data)
-            logging.info(f"Message published on 'channel:phase2_complete'")
-    
+      ensure_consumer_group(r)
+      # Primero lo que quedó sin confirmar de una ejecución anterior
+      left_pending = claim_pending(r, dept_lookup)
+
+      logging.info(f"Waiting messages on '{PHASE1_STREAM}'...")
+
+      while True:
+        entries = r.xreadgroup(PHASE1_GROUP, CONSUMER_NAME, {PHASE1_STREAM: '>'}, count=STREAM_READ_COUNT, block=STREAM_BLOCK_MS)
+        for _, messages in entries or []:
+          left_pending += process_entries(r, messages, dept_lookup)
+
+        # Sin mensajes nuevos: reintentar los que fallaron y siguen pendientes
+        if not entries and left_pending:
+          left_pending = process_own_pending(r, dept_lookup)
+
     except redis.exceptions.ConnectionError as e:
       logging.error(f"Connection error on Redis: {e}. Retry in 10s...")
       time.sleep(10)